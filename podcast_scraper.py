@@ -1,11 +1,18 @@
 import datetime
+import functools
 import logging
 import os
 import sys
-import toml
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from scrappers import Scraper, RssXmlScraper
 
+try:
+    import tomllib
+except ImportError:
+    # tomllib only joined the standard library in Python 3.11
+    import tomli as tomllib
+
 ### ----------------------------------
 ### MAIN AND FRIENDS
 ### ----------------------------------
@@ -46,7 +53,8 @@ def read_config(args: list) -> dict:
     if not os.path.exists(config_file_path):
         raise Exception("Can't find the configuration file {}.".format(config_file_path))
 
-    return toml.load(config_file_path)
+    with open(config_file_path, "rb") as config_file:
+        return tomllib.load(config_file)
     
 
 def main() -> None:
@@ -60,32 +68,49 @@ def main() -> None:
     log_level = config["general"]["log_level"] if "log_level" in config["general"] else "INFO"
     setup_logging(log_file, log_level)
 
-    logging.info("Commencing podcast scraping at {}".format(datetime.datetime.now())) # TODO: fix timestamp format
+    logging.info("Commencing podcast scraping at %s", datetime.datetime.now()) # TODO: fix timestamp format
 
     # Determine the active scrapers
     scrapers = config["scrapers"]
     active_scrapers = [scrapers[s] for s in scrapers.keys() if scrapers[s]["enabled"]]
     active_scraper_names = [s["name"] for s in active_scrapers]
-    logging.info("There are {} active scrapers: {}.".format(len(active_scrapers), active_scraper_names))
-
-    for scraper in active_scrapers:
-        logging.info("Scraping {}".format(scraper["name"]))
-        # Merge default config with scraper specific conig
-        scraper_config = config["defaults"].copy()
-        scraper_config.update(scraper)
-        scraper_config["delay"] = config["general"]["throttle_seconds"]
-        scraper_config["save_path"] = config["general"]["save_path"]
-
-        try:
-            scraper_object = scraper_factory(scraper_config)
-            scraper_object.scrape_podcast()
-        except Exception as e:
-            logging.critical("Unable to complete scraping for {}".format(scraper["name"]))
-            traceback.print_exception(type(e), e, e.__traceback__)
+    logging.info("There are %d active scrapers: %s.", len(active_scrapers), active_scraper_names)
+
+    # The general settings every scraper needs. These win over anything set on the scraper itself.
+    general_config = {"delay": config["general"]["throttle_seconds"], "save_path": config["general"]["save_path"]}
+
+    # Scrapers are independent and spend most of their time waiting on the network so run them side by side.
+    # At least one runs at a time, whatever max_parallel_scrapers is set to.
+    max_workers = max(config["general"]["max_parallel_scrapers"] if "max_parallel_scrapers" in config["general"] else 8, 1)
+    if active_scrapers:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(active_scrapers))) as executor:
+            list(executor.map(functools.partial(run_scraper, defaults=config["defaults"], general_config=general_config), active_scrapers))
 
     logging.info("Podcast scraping finished.")
 
 
+def run_scraper(scraper: dict, defaults: dict, general_config: dict) -> None:
+    """
+    Builds the configuration for a single scraper, creates it and lets it scrape. Any error is logged rather 
+    than raised so one broken podcast doesn't stop the others. 
+
+    params:
+    scraper: (dict) The scraper specific configuration, ie. an entry from the 'scrapers' section. 
+    defaults: (dict) The 'defaults' section of the configuration. 
+    general_config: (dict) The general settings shared by all scrapers, ie. delay and save_path. 
+    """
+    logging.info("Scraping %s", scraper["name"])
+    # Merge default config with scraper specific conig
+    scraper_config = {**defaults, **scraper, **general_config}
+
+    try:
+        scraper_object = scraper_factory(scraper_config)
+        scraper_object.scrape_podcast()
+    except Exception as e:
+        logging.critical("Unable to complete scraping for %s", scraper["name"])
+        traceback.print_exception(type(e), e, e.__traceback__)
+
+
 def setup_logging(log_file: str = "-", log_level: str = 'INFO') -> None:
     """
     Sets up the logging with basic config. There's two modes - to stdout or to a file. 
@@ -1,16 +1,32 @@
 from abc import ABC, abstractmethod
 import datetime
+import heapq
 import logging
 import requests
 import re
+import threading
 import time
 import os
 import utils
-from bs4 import BeautifulSoup
-from email.utils import parsedate_to_datetime
-import lxml
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from email.utils import mktime_tz, parsedate_tz
+from lxml import etree
+import shutil
+import string
 import traceback
 
+# Bytes read/written per iteration when saving an episode to disk
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+# Episodes are written to their download path plus this suffix and only renamed once complete
+PARTIAL_DOWNLOAD_SUFFIX = ".part"
+
+# lxml names namespaced elements by their fully qualified {namespace}tag name. Plenty of feeds still declare the
+# capitalised URI from Apple's older docs so both are accepted.
+ITUNES_NAMESPACES = ("http://www.itunes.com/dtds/podcast-1.0.dtd", "http://www.itunes.com/DTDs/Podcast-1.0.dtd")
+ITUNES_SEASON = tuple("{%s}season" % ns for ns in ITUNES_NAMESPACES)
+ITUNES_EPISODE = tuple("{%s}episode" % ns for ns in ITUNES_NAMESPACES)
+
 class Scraper(ABC):
     """
     The base class for all scrappers. Extending implementations need to only implement get_episodes_from_feed and
@@ -26,21 +42,54 @@ class Scraper(ABC):
         self.min_season_width = config["min_season_width"]
         self.min_episode_width = config["min_ep_number_width"]
         self.download_path_format = config["download_path_format"]
+        # Bound once so each episode's values go straight in without being unpacked into a new kwargs dict
+        self._format_download_path = self.download_path_format.format_map
+        # The names the format actually uses (eg. 'season' for both {season} and {season[0]}) so only those get worked out
+        self._download_path_fields = {re.split(r'[.\[]', field, maxsplit=1)[0]
+                                      for _, field, _, _ in string.Formatter().parse(self.download_path_format) if field}
         self.max_episodes = config["max_episodes"]
         self.halt_on_existing = config["halt_on_existing"]
         self.ignore_if_title_match_any = config["skip_if_matching"]
         self.title_must_match_one_of = config["fetch_if_matching"]
+        self._ignore_patterns = utils.compile_any(self.ignore_if_title_match_any)
+        self._fetch_patterns = utils.compile_any(self.title_must_match_one_of)
         self.get_episode_number_from_title = config["get_episode_number_from_title"]
         self.delete_episodes_if_over_limit = config["delete_episodes_if_over_limit"]
         self.max_episode_age_in_days = config["max_episode_age_in_days"] if "max_episode_age_in_days" in config else 0
         if self.max_episode_age_in_days > 0:
             self.max_age_delta = datetime.timedelta(days=self.max_episode_age_in_days)
+        # Episodes published before this are too old. Set at the start of each scrape, None when there's no age limit.
+        self._age_cutoff = None
+        # At least one download thread, whatever's configured
+        self.max_parallel_downloads = max(config["max_parallel_downloads"] if "max_parallel_downloads" in config else 4, 1)
+
+        # One session per scraper so the feed and all episode downloads reuse pooled keep-alive connections. Each
+        # download thread can hold a connection to the same host so the pool needs to be at least that big.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=self.max_parallel_downloads)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # Episodes which passed all checks and are waiting to be downloaded, keyed by download path
+        self._queued = dict()
+        # Names in each directory we've looked at, including queued episodes, keyed by directory path
+        self._dir_cache = dict()
+        # How many files are actually on disk in each directory in _dir_cache, kept up to date as we go
+        self._file_counts = dict()
+        # Directories in _dir_cache which didn't exist when they were read and haven't been created yet
+        self._missing_dirs = set()
+        # Guards directory creation, deleting old episodes and creating new files between download threads
+        self._dir_lock = threading.Lock()
+        # Downloads are started at most once every self.delay seconds. This is when the next one may start.
+        self._throttle_lock = threading.Lock()
+        self._next_download_time = 0.0
 
 
     def scrape_podcast(self) -> None:
         """
         Fetches the podcast feed, parses it, and then processes each episode, downloading those that meet all 
-        the criteria. 
+        the criteria. The checks are done in feed order first and then the episodes that passed are downloaded
+        concurrently. 
         """
         # Check the directory for the podcast and the season (if applicable) exist
         self.podcast_home_path = os.path.join(self.save_path, self.podcast_name)
@@ -51,20 +100,30 @@ class Scraper(ABC):
             self.delete_episodes_if_over_limit = False
         
         episodes = self.get_episodes_from_feed()
-        logging.debug("There are {} episodes".format(len(episodes)))
+        logging.debug("There are %d episodes", len(episodes))
         
-        status = "OK"
-        i = 0    
-        while status != "HALT":
-            status = self.scrape_episode(episodes[i])
-            i += 1
+        self._age_cutoff = datetime.datetime.now() - self.max_age_delta if self.max_episode_age_in_days > 0 else None
+        self._queued = dict()
+        self._dir_cache = dict()
+        self._file_counts = dict()
+        self._missing_dirs = set()
+
+        # Resolved once rather than on every pass of the loop
+        scrape_episode = self.scrape_episode
+        for episode in episodes:
+            if scrape_episode(episode) == "HALT":
+                break
 
-        logging.info("Scrape finished for {}.".format(self.podcast_name))
+        if self._queued:
+            with ThreadPoolExecutor(max_workers=self.max_parallel_downloads) as executor:
+                list(executor.map(self.__fetch_episode, self._queued.values()))
+
+        logging.info("Scrape finished for %s.", self.podcast_name)
 
 
     def scrape_episode(self, episode) -> str:
         """
-        Processes one episode from the feed. 
+        Processes one episode from the feed, queueing it for download if it passes all the checks. 
 
         params:
         episode (Node): A node of the XML doc with the episode data. 
@@ -75,11 +134,13 @@ class Scraper(ABC):
             episode_data = self.get_episode_data(episode)
             episode_status = self.__check_episode(episode_data)
             if episode_status == "OK":
-                logging.info("Downloading episode #{episode} - {title}".format(**episode_data))
-                self.__download_episode(episode_data)
+                # Reserve the file name so later checks see the episode as already fetched
+                download_dir, filename = os.path.split(episode_data["download_path"])
+                self.__dir_contents(download_dir).add(filename)
+                self._queued[episode_data["download_path"]] = episode_data
             return episode_status
         except Exception as e:
-            logging.critical("Error while processing episode {} because {}: {}. Skipping.".format(episode.title.text, type(e), e))
+            logging.critical("Error while processing episode %s because %s: %s. Skipping.", episode.findtext("title"), type(e), e)
             traceback.print_exception(type(e), e, e.__traceback__)
             return "SKIP"
 
@@ -119,15 +180,19 @@ class Scraper(ABC):
         returns str: The path to download episode to. 
         """
         path_values = dict()
-        path_values["ep_title"] = utils.tidy_up_title(episode_data["title"])
+        fields = self._download_path_fields
+        if "ep_title" in fields:
+            path_values["ep_title"] = utils.tidy_up_title(episode_data["title"])
   
         # Pad out season and episode numbers
-        if "season" in episode_data:
-            path_values["season"] = episode_data["season"].zfill(self.min_season_width)
-        path_values["ep_number"] = episode_data["episode"].zfill(self.min_episode_width)
+        season = episode_data.get("season")
+        if season is not None and "season" in fields:
+            path_values["season"] = season.zfill(self.min_season_width)
+        if "ep_number" in fields:
+            path_values["ep_number"] = episode_data["episode"].zfill(self.min_episode_width)
         
-        filename = self.download_path_format.format(**path_values)
-        return os.path.join(self.save_path, self.podcast_name, filename)
+        filename = self._format_download_path(path_values)
+        return os.path.join(self.podcast_home_path, filename)
         
 
     def __check_episode(self, episode_data: dict) -> str:
@@ -144,49 +209,76 @@ class Scraper(ABC):
         return str: The action to take (as described above)
         """
         # has no URL
-        if "url" not in episode_data or episode_data["url"] is None:
-            logging.info("Skipping episode {} - no download URL.".format(episode_data["unparsed_title"]))
+        if not episode_data.get("url"):
+            logging.info("Skipping episode %s - no download URL.", episode_data["unparsed_title"])
             return "SKIP"
 
         # no match bad regexes
-        if len(self.ignore_if_title_match_any) and utils.matches_any(episode_data["unparsed_title"], self.ignore_if_title_match_any):
-            logging.info("Skipping episode {} - title matches an exlcusion filter, one of: {}.".format(episode_data["unparsed_title"], self.ignore_if_title_match_any))
+        if len(self.ignore_if_title_match_any) and utils.matches_any(episode_data["unparsed_title"], self._ignore_patterns):
+            logging.info("Skipping episode %s - title matches an exlcusion filter, one of: %s.", episode_data["unparsed_title"], self.ignore_if_title_match_any)
             return "SKIP"       
         
         # matches one good regex
-        if len(self.title_must_match_one_of) and not utils.matches_any(episode_data["unparsed_title"], self.title_must_match_one_of):
-            logging.info("Skipping episode {} - title does not meet requirements to match at least one of: {}.".format(episode_data["unparsed_title"], self.title_must_match_one_of))
+        if len(self.title_must_match_one_of) and not utils.matches_any(episode_data["unparsed_title"], self._fetch_patterns):
+            logging.info("Skipping episode %s - title does not meet requirements to match at least one of: %s.", episode_data["unparsed_title"], self.title_must_match_one_of)
             return "SKIP"
 
-        # Already exists
+        # Already exists or is already going to be downloaded
         episode_data["download_path"] = self.__determine_download_path(episode_data)
-        if os.path.exists(episode_data["download_path"]):
+        path, filename = os.path.split(episode_data["download_path"])
+        if filename in self.__dir_contents(path):
            # Halt or keep going? 
            if self.halt_on_existing:
-               logging.info("Halting on episode {} - already fetched. Scraper is up to date.".format(episode_data["unparsed_title"]))
+               logging.info("Halting on episode %s - already fetched. Scraper is up to date.", episode_data["unparsed_title"])
                return "HALT"
            else:
-               logging.debug("Skipping episode {} - already fetched.".format(episode_data["unparsed_title"]))
+               logging.debug("Skipping episode %s - already fetched.", episode_data["unparsed_title"])
                return "SKIP"
         
         # not too old - HALT rather than skip on the (validated) assumption that feeds are in descending chonological order
-        now = datetime.datetime.now()
-        if self.max_episode_age_in_days > 0:
-            if (now - self.max_age_delta) > episode_data["published_date"]:
-                logging.info("Halting on episode {} due to it being too old (published more than {} days ago)".format(episode_data["title"], self.max_episode_age_in_days))
-                return "HALT"                
+        if self._age_cutoff is not None and self._age_cutoff > episode_data["published_date"]:
+            logging.info("Halting on episode %s due to it being too old (published more than %s days ago)", episode_data["title"], self.max_episode_age_in_days)
+            return "HALT"
         
         # not too many existing or we can delete episodes if needed
-        path = os.path.dirname(episode_data["download_path"])
-        current_episodes = len(os.listdir(path)) if os.path.exists(path) else 0
+        current_episodes = len(self.__dir_contents(path))
         if current_episodes and (0 < self.max_episodes <= current_episodes) and not self.delete_episodes_if_over_limit:
-            logging.info("Halting on episode {} due to the maxium number of episodes for this podcast reached ({})".format(episode_data["title"], self.max_episodes))
+            logging.info("Halting on episode %s due to the maxium number of episodes for this podcast reached (%s)", episode_data["title"], self.max_episodes)
             return "HALT"
 
         # No reason not to fetch it. 
         return "OK"
 
 
+    def __dir_contents(self, path: str) -> set:
+        """
+        Gets the names of everything in a directory, reading the directory from disk only the first time it's
+        asked for during a scrape. The returned set is the cached one so callers can keep it up to date. 
+
+        params:
+        path: (str) The directory to look in. It doesn't have to exist. 
+
+        returns set[str]: The names of the files and directories in the directory, empty if it doesn't exist. 
+                          Partial downloads left from an earlier scrape are deleted and left out. 
+        """
+        if path not in self._dir_cache:
+            try:
+                with os.scandir(path) as entries:
+                    names = {entry.name for entry in entries}
+                # Nothing has been downloaded yet this scrape so any partial downloads were left by an earlier one 
+                # which got interrupted. They're never picked up again so clear them out. 
+                partials = {name for name in names if name.endswith(PARTIAL_DOWNLOAD_SUFFIX)}
+                for name in partials:
+                    logging.debug("Deleting partial download '%s' left by an earlier scrape.", name)
+                    self.__remove_partial_download(os.path.join(path, name))
+                self._dir_cache[path] = names - partials
+            except FileNotFoundError:
+                self._dir_cache[path] = set()
+                self._missing_dirs.add(path)
+            self._file_counts[path] = len(self._dir_cache[path])
+        return self._dir_cache[path]
+
+
     def __delete_old_episodes_if_needed(self, download_path: str) -> None:
         """
         Deletes old episodes in order to get a podcast under the limit to download a new episode. Will delete as many episodes
@@ -197,15 +289,36 @@ class Scraper(ABC):
         """
         path = os.path.dirname(download_path)
         # The +1 is because we're about to download a new episode
-        over_limit = len(os.listdir(path)) - (self.max_episodes + 1) 
+        # The directory was already read when the episode was checked
+        over_limit = self._file_counts[path] - (self.max_episodes + 1) 
 
         if self.delete_episodes_if_over_limit and over_limit > 0:
-            # Determine the oldest n files and delete them
-            files = [os.path.join(path, f) for f in os.listdir(path) if not os.path.isdir(os.path.join(path, f))] # Exclude directories
-            episodes = sorted(files, key=os.path.getctime)
-            for ep in episodes[0:over_limit]:
-                logging.debug("Deleting epsiode '{}' to observe epsidoe limit ({}).".format(ep, self.max_episodes))
+            # Determine the oldest n files and delete them. DirEntry gets the file type from the directory read itself
+            with os.scandir(path) as entries:
+                # Exclude directories and downloads still in progress
+                episodes = [(entry.stat().st_ctime, entry.path) for entry in entries if entry.is_file() and not entry.name.endswith(PARTIAL_DOWNLOAD_SUFFIX)]
+            # Only the oldest few are wanted so there's no need to sort the lot
+            for _, ep in heapq.nsmallest(over_limit, episodes):
+                logging.debug("Deleting epsiode '%s' to observe epsidoe limit (%s).", ep, self.max_episodes)
                 os.remove(ep)
+                self._dir_cache[path].discard(os.path.basename(ep))
+                self._file_counts[path] -= 1
+
+
+    def __fetch_episode(self, episode_data) -> None:
+        """
+        Downloads one queued episode. Run on the download thread pool so any error is logged here rather than
+        lost in the executor. 
+
+        params: 
+        episode_data: (dict[str, *]) The return value of get_episode_data, all available data for the episode. 
+        """
+        try:
+            logging.info("Downloading episode #%s - %s", episode_data["episode"], episode_data["title"])
+            self.__download_episode(episode_data)
+        except Exception as e:
+            logging.critical("Error while downloading episode %s because %s: %s. Skipping.", episode_data["unparsed_title"], type(e), e)
+            traceback.print_exception(type(e), e, e.__traceback__)
 
 
     def __download_episode(self, episode_data) -> None:
@@ -216,29 +329,76 @@ class Scraper(ABC):
         params: 
         episode_data: (dict[str, *]) The return value of get_episode_data, all available data for the episode. 
         """
-        # Check the directory for the podcast and the season (if applicable) exist
-        if not os.path.exists(self.podcast_home_path):
-            logging.debug("Creating podcast home path {}".format(self.podcast_home_path))
-            os.mkdir(self.podcast_home_path)
+        download_path = episode_data["download_path"]
+        partial_path = download_path + PARTIAL_DOWNLOAD_SUFFIX
+
+        # Delay to not overload servers
+        self.__wait_for_download_slot()
+        fileResp = self.session.get(episode_data["url"], stream = True)
+
+        # Always hand the pooled connection back, even if the download never gets going
+        with fileResp:
+            fileResp.raise_for_status()
+            # Let urllib3 undo any transfer encoding (eg. gzip) since we're reading from the raw stream
+            fileResp.raw.decode_content = True
+
+            # Only one thread at a time gets to touch the directory so the episode limit holds
+            with self._dir_lock:
+                # Make sure the directory for the podcast and the season (if applicable) exist. Reading the directory 
+                # when the episode was checked already told us if it's there.
+                season_path = os.path.split(episode_data["download_path"])[0]
+                if season_path in self._missing_dirs:
+                    os.makedirs(season_path, exist_ok=True)
+                    self._missing_dirs.discard(season_path)
+
+                # Delete epsidoes if needed to stick to limit, if a limit exists AND permitted to delete stuff
+                if self.max_episodes and self.delete_episodes_if_over_limit:
+                    self.__delete_old_episodes_if_needed(episode_data["download_path"])       
+
+                # Create the file before letting go of the lock so other threads count it against the limit
+                fd = open(partial_path, 'wb')
+                self._file_counts[season_path] += 1
+
+            logging.debug("Downloading episode #%s - %s to %s.", episode_data["episode"], episode_data["title"], download_path)
+            try:
+                with fd:
+                    shutil.copyfileobj(fileResp.raw, fd, length=DOWNLOAD_CHUNK_SIZE)
+                # Only now is the episode complete, so only now does it get its real name
+                os.replace(partial_path, download_path)
+            except Exception as e:
+                # Never leave half an episode behind - the next scrape starts it again from scratch
+                logging.critical("Unable to download %s due to %s", episode_data["url"], e)        
+                with self._dir_lock:
+                    self._file_counts[season_path] -= 1
+                    self.__remove_partial_download(partial_path)
+
+
+    def __remove_partial_download(self, partial_path: str) -> None:
+        """
+        Deletes an incomplete download, if it's there. 
 
-        season_path = os.path.split(episode_data["download_path"])[0]
-        if not os.path.exists(season_path):
-            logging.debug("Creating season path {}".format(season_path))
-            os.mkdir(season)
+        params:
+        partial_path: (str) The path of the partial download. 
+        """
+        try:
+            os.remove(partial_path)
+        except FileNotFoundError:
+            pass
 
-        # Delete epsidoes if needed to stick to limit, if a limit exists AND permitted to delete stuff
-        if self.max_episodes and self.delete_episodes_if_over_limit:
-            self.__delete_old_episodes_if_needed(episode_data["download_path"])       
 
-        fileResp = requests.get(episode_data["url"], stream = True)
-        logging.debug("Downloading episode #{episode} - {title} to {download_path}.".format(**episode_data))
-        try:
-            with open(episode_data["download_path"], 'wb') as fd:
-                for chunk in fileResp.iter_content(chunk_size=1024):
-                    fd.write(chunk)
-            time.sleep(self.delay) # Delay to not overload servers
-        except e:
-            logging.critical("Unable to download {} due to {}".format(episode_data["url"], e))        
+    def __wait_for_download_slot(self) -> None:
+        """
+        Blocks until this scraper is allowed to start another download, so that downloads start no more often than 
+        once every self.delay seconds. Only sleeps for whatever is left of the delay - if the last download started 
+        long enough ago there's no wait at all. 
+        """
+        with self._throttle_lock:
+            now = time.monotonic()
+            start_time = max(now, self._next_download_time)
+            self._next_download_time = start_time + self.delay
+
+        if start_time > now:
+            time.sleep(start_time - now)
 
 
 class RssXmlScraper(Scraper):
@@ -248,48 +408,69 @@ class RssXmlScraper(Scraper):
 
     def __init__(self, config):
         if "title_parsing_regex" in config: 
-            self.title_parsing_regex = config["title_parsing_regex"]
+            self.title_parsing_regex = re.compile(config["title_parsing_regex"])
             self.episode_number_source = 'TITLE'
         else:
             self.title_parsing_regex = None
             self.episode_number_source = config["episode_number_source"] if "episode_number_source" in config else "METADATA"
+        # For COUNT numbering - the next episode number going by what's on disk. Worked out once per scrape.
+        self._next_episode_number = None
         
         super(RssXmlScraper, self).__init__(config)
 
 
+    def scrape_podcast(self):
+        self._next_episode_number = None
+        super(RssXmlScraper, self).scrape_podcast()
+
+
     def get_episodes_from_feed(self):
-        response = requests.get(self.feed_url, headers={'User-Agent': 'curl/7.68.0'})
-        dom = BeautifulSoup(response.text, 'xml')
-        return dom.find_all('item')
+        response = self.session.get(self.feed_url, headers={'User-Agent': 'curl/7.68.0'})
+        # Hand lxml the raw bytes so it honours the feed's own encoding declaration. Recover so that slightly
+        # broken feeds still parse, as they did under BeautifulSoup.
+        dom = etree.fromstring(response.content, etree.XMLParser(recover=True))
+        return list(dom.iter('item'))
 
 
     def get_episode_data(self, ep):
         episode_data = dict()
-        if ep.find('itunes:season') is not None:
-            episode_data["season"] = ep.find('itunes:season').text
-        unzoned_timestamp = parsedate_to_datetime(ep.pubDate.text).timestamp()
+        # One pass over the item's children instead of a search per field. Reversed so that if a tag is repeated the
+        # first one wins.
+        children = {child.tag: child for child in reversed(ep)}
+
+        season = next((children[tag] for tag in ITUNES_SEASON if tag in children), None)
+        if season is not None:
+            episode_data["season"] = season.text or ''
+        # Straight to a UTC timestamp, taking the date's offset into account, without building an aware datetime first
+        unzoned_timestamp = mktime_tz(parsedate_tz(children["pubDate"].text))
         episode_data["published_date"] = datetime.datetime.utcfromtimestamp(unzoned_timestamp)
-        episode_data["url"] = ep.find("enclosure")['url'] 
+        enclosure = children.get("enclosure")
+        episode_data["url"] = enclosure.get("url") if enclosure is not None else None
  
-        episode_data["title"] = ep.title.text
-        episode_data["unparsed_title"] = ep.title.text
-        if ep.find('itunes:episode') is not None:
-            episode_data["episode"] = ep.find('itunes:episode').text
+        title = children["title"].text or ''
+        episode_data["title"] = title
+        episode_data["unparsed_title"] = title
+        episode = next((children[tag] for tag in ITUNES_EPISODE if tag in children), None)
+        if episode is not None:
+            episode_data["episode"] = episode.text or ''
 
         # manual extract title and episode number
         if self.episode_number_source == 'TITLE':
-           regex = re.search(self.title_parsing_regex, ep.title.text)
+           regex = self.title_parsing_regex.search(title)
            # Title does not parse if there isnn't 2 groups
            if regex is not None and len(regex.groups()) >= 2:
                episode_data["episode"] = regex.group(1)
                episode_data["title"] = regex.group(2)
            else:
-               parsed = utils.simple_title_parsing(ep.title.text)
+               parsed = utils.simple_title_parsing(title)
                episode_data["episode"] = parsed[0]
                episode_data["title"] = parsed[1]
         elif self.episode_number_source == 'COUNT':
-            # Cast from int to str for consistency
-            episode_data['episode'] = str(utils.infer_episode_number_from_path(self.podcast_home_path))
+            # Nothing is downloaded until every episode is checked so the directory only needs reading once
+            if self._next_episode_number is None:
+                self._next_episode_number = utils.infer_episode_number_from_path(self.podcast_home_path)
+            # Cast from int to str for consistency. Queued episodes aren't on disk yet so count them too.
+            episode_data['episode'] = str(self._next_episode_number + len(self._queued))
  
         return episode_data
 
@@ -1,9 +1,16 @@
-import datetime
-import glob
-import logging
 import os
 import re
 
+# Table for tidy_up_title which deletes the characters we don't want in a filename in one pass.
+_TITLE_STRIP_TABLE = str.maketrans('', '', '!?$/:;"\u0000\u0093â')
+# Numbered or named backreferences and conditional group references, which would point at the wrong group once
+# patterns are joined together.
+_BACKREFERENCE_RE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+# Inline global flags such as (?i), which would apply to every joined pattern rather than just their own.
+_GLOBAL_FLAGS_RE = re.compile(r'\(\?[aiLmsux]+\)')
+# A leading episode number, one separator character and then the title. Used by simple_title_parsing.
+_SIMPLE_TITLE_RE = re.compile(r'^(\d+)\D?\s*(.*)$', re.DOTALL)
+
 ### ----------------------------------
 ### UTILITY METHODS
 ### ----------------------------------
@@ -14,18 +21,42 @@ def matches_any(s: str, regexes: list) -> bool:
 
     params:
     s: (str) The test string
-    regexes: (list) The tests. 
+    regexes: (list[re.Pattern]) The tests, already compiled. 
 
     returns bool: returns True if the string matches any one of the regular expressions. 
     """
 
     for regex in regexes:
-        if re.match(regex, s) is not None:
+        if regex.match(s) is not None:
             return True
 
     return False
 
 
+def compile_any(regexes: list) -> list:
+    """
+    Compiles a list of regular expressions for use with matches_any. Where it's safe the expressions are joined
+    into a single alternation so matches_any only has to run one match rather than one per expression. 
+
+    Expressions using backreferences, conditional groups or inline global flags (eg. (?i)) can't be joined and are compiled 
+    individually instead. 
+
+    params:
+    regexes: (list[str]) The regular expressions. 
+
+    returns list[re.Pattern]: The compiled expressions - a single pattern if they could be joined. 
+    """
+    patterns = [re.compile(regex) for regex in regexes]
+    if len(patterns) < 2 or any(_BACKREFERENCE_RE.search(regex) or _GLOBAL_FLAGS_RE.search(regex) for regex in regexes):
+        return patterns
+
+    try:
+        return [re.compile('|'.join('(?:{})'.format(regex) for regex in regexes))]
+    except re.error:
+        # Fine on their own but not together, eg. the same group name used in more than one
+        return patterns
+
+
 def tidy_up_title(title: str) -> str:
     """
     Cleans up a title by removing characters we don't want in a filename. 
@@ -35,30 +66,26 @@ def tidy_up_title(title: str) -> str:
 
     returns str: a nice, clean title. 
     """
-    title = re.sub('[!?$/:;"\u0000\u0093â]', '', title)
-    title = re.sub(', ', ' - ', title)
-    return title
+    return title.translate(_TITLE_STRIP_TABLE).replace(', ', ' - ')
 
 
 def simple_title_parsing(original_title: str) -> (str, str):
     """
-    Parses the title without resorting to regular expressions. This is to assist with cases where the regexes
-    seem to fail. Especially cases with titles like [num]: [title] or [num]-[title]. 
+    Parses the title with a simple fixed pattern rather than the configured regex. This is to assist with cases 
+    where the regexes seem to fail. Especially cases with titles like [num]: [title] or [num]-[title]. 
 
-    If the input doesnt start with numeric characters then this function is no good. 
+    If the input doesnt start with numeric characters then this function is no good - the episode number 
+    comes back empty and the title is returned as is. 
 
     params:
     original_title: (str) the original title
 
     returns tuple(str, str): the episode number and the title as a tuple. 
     """
-    index = 0
-    while original_title[index].isnumeric():
-        index += 1
-    
-    episode = original_title[:index]
-    title = original_title[index+1:].strip()
-    return (episode, title)
+    match = _SIMPLE_TITLE_RE.match(original_title)
+    if match is None:
+        return ('', original_title)
+    return (match.group(1), match.group(2).strip())
 
 
 def infer_episode_number_from_path(path: str) -> (int):
@@ -74,18 +101,24 @@ def infer_episode_number_from_path(path: str) -> (int):
 
     returns (int): The next episode number for the podcast.
     """
-    # No directory - first episode
-    if not os.path.exists(path):
+    # Identify the newest MP3 in one pass over the directory
+    newest_file = None
+    newest_mtime = None
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.endswith('.mp3') and not entry.name.startswith('.') and entry.is_file():
+                    mtime = entry.stat().st_mtime
+                    if newest_mtime is None or mtime > newest_mtime:
+                        newest_file = entry.name
+                        newest_mtime = mtime
+    except FileNotFoundError:
+        # No directory - first episode
         return 1
 
-    files = os.listdir(path)
-    
-    # Nothing there: first episode
-    if len(files) == 0:
+    # No MP3s there: first episode
+    if newest_file is None:
         return 1
 
-    # Identify the newest file
-    newest_file = max(glob.iglob('{}/*.mp3'.format(path)), key=os.path.getmtime)
-    newest_file = newest_file.split('/')[-1]
     episode = simple_title_parsing(newest_file)[0]
     return int(episode.lstrip('0')) + 1